@@ -6,9 +6,106 @@
 #              retrieval with filtering, detailed message analysis, and attachment extraction
 #              for security investigations and email forensics.
 
+import hashlib
+import itertools
+import os
+import threading
+import time
 import requests
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 
+# orjson parses Graph responses several times faster than the standard library; it is optional
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# pybase64 decodes attachment content several times faster than the standard library; it is optional
+try:
+    import pybase64 as _base64
+except ImportError:
+    import base64 as _base64
+
+# ijson lets message pages be parsed incrementally as they arrive; it is optional
+try:
+    import ijson as _ijson
+except ImportError:
+    _ijson = None
+
+# Graph JSON batching endpoint and the maximum number of sub-requests it accepts per POST
+batch_url = "https://graph.microsoft.com/v1.0/$batch"
+batch_limit = 20
+
+# Largest attachment whose content is fetched inside a $batch response; binary content is returned base64
+# encoded (a third larger) and Graph limits batch payloads to about 4 MB
+batch_attachment_max_size = 3 * 1024 * 1024
+
+# Largest page size Graph accepts for message collections
+max_page_size = 999
+
+# Maximum number of concurrent Graph requests issued by the fan-out helpers
+max_workers = 32
+
+# Chunk size used when streaming attachment content
+download_chunk_size = 64 * 1024
+
+# Most bytes read from an abandoned message page to return its connection to the pool; reading more than a
+# new TCP/TLS handshake costs is not worth it, so larger remainders close the connection instead
+drain_limit = 256 * 1024
+
+# Throttled (429) and transient server error responses are retried up to retry_total times with exponential
+# backoff, waiting for the Retry-After interval when Graph provides one
+retry_total = 8
+retry_backoff_factor = 0.5
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# Shared session so every call reuses pooled keep-alive connections instead of a new TCP/TLS handshake.
+# POST is retried as well, since the token and $batch requests made by this module do not modify anything.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=retry_total,
+        backoff_factor=retry_backoff_factor,
+        status_forcelist=retry_status_codes,
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+
+# Access tokens cached by (tenant_id, client_id) as (token, monotonic expiry time), refreshed
+# token_expiry_margin seconds before they expire
+_token_cache = {}
+_token_lock = threading.Lock()
+
+# One refresh lock per (tenant_id, client_id), so a slow or throttled tenant never blocks the others
+_token_refresh_locks = {}
+token_expiry_margin = 60
+
+# Folder lookups cached by (mailbox, token digest, lookup, argument) as (result, monotonic expiry time); folder
+# IDs are stable, so repeat lookups within folder_cache_ttl seconds skip the Graph round-trip. Keying on the token
+# means a caller only ever sees results fetched with its own token, so Graph still enforces its access. Expired
+# entries are purged on lookup and insert, and the least recently used are evicted beyond folder_cache_size
+_folder_cache = OrderedDict()
+_folder_lock = threading.Lock()
+folder_cache_ttl = 3600
+folder_cache_size = 1024
+
+# Raw response bodies cached by request URL as (ETag, body bytes) so repeat fetches can be revalidated with
+# If-None-Match; bodies are parsed again on every hit so callers never share objects, and the least recently
+# used entries are evicted once the cached bodies exceed etag_cache_bytes in total
+_etag_cache = OrderedDict()
+_etag_cache_size = 0
+_etag_lock = threading.Lock()
+etag_cache_bytes = 16 * 1024 * 1024
+
 # Default message fields to retrieve from Graph API for comprehensive email analysis
 default_fields = [
     'id',
@@ -46,10 +143,23 @@ default_fields = [
     'multiValueExtendedProperties'
 ]
 
+# Default message fields to retrieve when listing messages; use get_message_details for the full default_fields set
+default_list_fields = [
+    'id',
+    'subject',
+    'receivedDateTime',
+    'hasAttachments'
+]
+
+# Precomputed $select values for the default field lists, so the common case skips the per-call join
+_default_select = ','.join(default_fields)
+_default_list_select = ','.join(default_list_fields)
+
 
 def get_access_token(tenant_id, client_id, client_secret):
     """
     Authenticates to Microsoft Graph API using client credentials grant and returns an access token.
+    Tokens are cached per tenant and client and reused until shortly before they expire.
 
     :param tenant_id: The Azure AD tenant ID
     :param client_id: The application (client) ID
@@ -57,24 +167,47 @@ def get_access_token(tenant_id, client_id, client_secret):
     :return: Access token string for Microsoft Graph API requests
     """
 
-    # OAuth2 token endpoint for the specified tenant
-    authority_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    cache_key = (tenant_id, client_id)
 
-    # Client credentials grant request payload
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'scope': 'https://graph.microsoft.com/.default'
-    }
+    # The global lock only guards the cache itself and is never held across the token request
+    with _token_lock:
+        cached = _token_cache.get(cache_key)
+        if cached and time.monotonic() < cached[1] - token_expiry_margin:
+            return cached[0]
 
-    # Request access token from Azure AD
-    response = requests.post(authority_url, data=payload)
-    response.raise_for_status()
+        refresh_lock = _token_refresh_locks.setdefault(cache_key, threading.Lock())
+
+    # Hold the per-key lock across the refresh so a burst of callers issues a single token request
+    with refresh_lock:
+        # Another caller may have refreshed the token while this one was waiting
+        with _token_lock:
+            cached = _token_cache.get(cache_key)
+            if cached and time.monotonic() < cached[1] - token_expiry_margin:
+                return cached[0]
 
-    # Extract and return the access token
-    token = response.json().get('access_token')
-    return token
+        # OAuth2 token endpoint for the specified tenant
+        authority_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+
+        # Client credentials grant request payload
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'scope': 'https://graph.microsoft.com/.default'
+        }
+
+        # Request access token from Azure AD
+        response = _session.post(authority_url, data=payload)
+        response.raise_for_status()
+
+        # Extract the access token and cache it until it expires
+        data = _parse(response)
+        token = data.get('access_token')
+
+        with _token_lock:
+            _token_cache[cache_key] = (token, time.monotonic() + int(data.get('expires_in', 0)))
+
+        return token
 
 
 def get_folders(mailbox, access_token):
@@ -85,18 +218,19 @@ def get_folders(mailbox, access_token):
     :param access_token: Bearer token for Microsoft Graph API authentication
     :return: Dictionary with folder display names as keys and folder IDs as values
     """
+
+    # Return the cached lookup if it has not expired
+    cache_key = (mailbox.lower(), _token_digest(access_token), 'folders', None)
+    folders = _get_cached_folders(cache_key)
+    if folders is not None:
+        return dict(folders)
+
     # Graph API endpoint for mailbox folders
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    headers = _headers(access_token)
 
-    data = response.json()
+    data = _get_conditional(url, headers)
 
     # Validate that we found the mailbox and it contains folders
     if not data.get('value') or len(data['value']) == 0:
@@ -105,6 +239,8 @@ def get_folders(mailbox, access_token):
     # Create dictionary mapping folder names to IDs for easy lookup
     folders = {folder['displayName']: folder['id'] for folder in data.get('value', [])}
 
+    _cache_folders(cache_key, dict(folders))
+
     return folders
 
 
@@ -118,22 +254,28 @@ def get_folder_id(mailbox, folder_id_filter, access_token):
     :return: The ID of the first folder matching the filter
     """
 
+    # Return the cached lookup if it has not expired
+    cache_key = (mailbox.lower(), _token_digest(access_token), 'folder_id', folder_id_filter)
+    folder_id = _get_cached_folders(cache_key)
+    if folder_id is not None:
+        return folder_id
+
     # Graph API endpoint for mailbox folders
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = _headers(access_token)
 
+    # Only the first matching ID is needed, so avoid transferring sibling folders and their properties
     params = {
-        '$filter': folder_id_filter
+        '$filter': folder_id_filter,
+        '$top': 1,
+        '$select': 'id'
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    response = _session.get(url, headers=headers, params=params)
     response.raise_for_status()
 
-    data = response.json()
+    data = _parse(response)
 
     # Validate that we found matching folders
     if not data.get('value') or len(data['value']) == 0:
@@ -141,8 +283,11 @@ def get_folder_id(mailbox, folder_id_filter, access_token):
 
     folder_id = data['value'][0]['id']
 
+    _cache_folders(cache_key, folder_id)
+
     return folder_id
 
+
 def get_child_folders(mailbox, main_folder_id, access_token):
     """
     Retrieves all child folders from a specified mailbox and folder and returns them as a dictionary.
@@ -153,18 +298,18 @@ def get_child_folders(mailbox, main_folder_id, access_token):
     :return: Dictionary with child folder display names as keys and child folder IDs as values
     """
 
+    # Return the cached lookup if it has not expired
+    cache_key = (mailbox.lower(), _token_digest(access_token), 'child_folders', main_folder_id)
+    child_folders = _get_cached_folders(cache_key)
+    if child_folders is not None:
+        return dict(child_folders)
+
     # Graph API endpoint for mailbox folders
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{main_folder_id}/childFolders"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    headers = _headers(access_token)
 
-    data = response.json()
+    data = _get_conditional(url, headers)
 
     # Validate that we found matching folders
     if not data.get('value') or len(data['value']) == 0:
@@ -172,51 +317,149 @@ def get_child_folders(mailbox, main_folder_id, access_token):
 
     child_folders = {folder['displayName']: folder['id'] for folder in data.get('value', [])}
 
+    _cache_folders(cache_key, dict(child_folders))
+
     return child_folders
 
 
-def get_messages(mailbox, folder_id, access_token, filter_query=None, top=100):
+def invalidate_folder_cache(mailbox=None):
     """
-    Retrieves messages from a specified folder within a mailbox and returns them as a dictionary.
+    Discards cached folder lookups so the next call queries Graph again.
+
+    :param mailbox: Optional email address of the mailbox to invalidate (defaults to all mailboxes)
+    """
+
+    with _folder_lock:
+        if mailbox is None:
+            _folder_cache.clear()
+        else:
+            for cache_key in [key for key in _folder_cache if key[0] == mailbox.lower()]:
+                del _folder_cache[cache_key]
+
+
+def iter_messages(mailbox, folder_id, access_token, filter_query=None, page_size=max_page_size, select_fields=None):
+    """
+    Yields messages from a specified folder within a mailbox, following @odata.nextLink across pages.
+    When ijson is installed each page is parsed incrementally, so messages are yielded as they arrive.
+    A caller that stops iterating early should close() the generator (or let it be garbage collected)
+    so the remainder of the current page (up to drain_limit bytes) is drained and its connection returned to the pool.
 
     :param mailbox: The email address of the mailbox to query
     :param folder_id: The ID of the folder containing the messages
     :param access_token: Bearer token for Microsoft Graph API authentication
     :param filter_query: Optional OData filter expression to filter messages
-    :param top: Maximum number of messages to retrieve (default: 100)
-    :return: Dictionary containing message data from the API response
+    :param page_size: Number of messages requested per page (default: max_page_size)
+    :param select_fields: Optional list of specific fields to retrieve (defaults to default_list_fields)
+    :return: Generator yielding message dictionaries
     """
 
-
     # Graph API endpoint for messages in specific folder
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = _headers(access_token)
 
-    # Set query parameters - always include top to avoid default limit of 10
+    # Set query parameters - always include top to avoid default page size of 10
     params = {
-        '$top': top  # Default to 100 instead of API's default 10
+        '$top': page_size,
+        '$select': _default_list_select if select_fields is None else ','.join(select_fields)
     }
 
     # Add optional filter if provided
     if filter_query:
         params['$filter'] = filter_query
 
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
+    while url:
+        page = {}
+
+        # Stream each page so messages are yielded while the rest of the page is still arriving
+        with _session.get(url, headers=headers, params=params, stream=True) as response:
+            response.raise_for_status()
+
+            try:
+                yield from _iter_page(response, page)
+            finally:
+                # Read whatever the caller did not consume so the connection returns to the pool
+                _drain(response)
 
-    messages = response.json()
+        # The next link already carries the query parameters of the original request
+        url = page.get('@odata.nextLink')
+        params = None
+
+
+def get_messages(mailbox, folder_id, access_token, filter_query=None, top=100, select_fields=None):
+    """
+    Retrieves messages from a specified folder within a mailbox and returns them as a dictionary.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder containing the messages
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :param filter_query: Optional OData filter expression to filter messages
+    :param top: Maximum number of messages to retrieve, or None for all messages (default: 100)
+    :param select_fields: Optional list of specific fields to retrieve (defaults to default_list_fields)
+    :return: Dictionary containing the retrieved messages under the 'value' key
+    """
+
+    # Avoid over-fetching when fewer messages than a full page are wanted
+    page_size = max_page_size if top is None else min(top, max_page_size)
+
+    messages = {
+        'value': list(itertools.islice(iter_messages(mailbox, folder_id, access_token, filter_query, page_size, select_fields), top))
+    }
 
     # Validate that the folder contains messages
-    if not messages.get('value') or len(messages['value']) == 0:
+    if not messages['value']:
         raise ValueError(f"Could not find messages in folder for mailbox: {mailbox}")
 
     return messages
 
 
+def get_messages_delta(mailbox, folder_id, delta_link, access_token, select_fields=None):
+    """
+    Retrieves messages added, changed or removed in a folder since a previous delta query.
+    Pass delta_link=None for the initial scan, then pass the returned delta link on later scans.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder to track
+    :param delta_link: The @odata.deltaLink returned by a previous call, or None to start a new scan
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :param select_fields: Optional list of specific fields to retrieve on the initial scan (defaults to default_list_fields)
+    :return: Tuple of (list of changed message dictionaries, delta link for the next scan)
+    """
+
+    if delta_link:
+        # The delta link already carries the query parameters of the initial scan
+        url = delta_link
+        params = None
+    else:
+        # Graph API endpoint for message changes in specific folder
+        url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages/delta"
+
+        params = {
+            '$select': _default_list_select if select_fields is None else ','.join(select_fields)
+        }
+
+    # Delta queries size their pages through the Prefer header rather than $top
+    headers = dict(_headers(access_token), Prefer=f"odata.maxpagesize={max_page_size}")
+
+    messages = []
+    new_delta_link = None
+
+    # Follow next links until Graph returns the delta link marking the end of the changes
+    while url:
+        page = {}
+
+        with _session.get(url, headers=headers, params=params, stream=True) as response:
+            response.raise_for_status()
+
+            messages.extend(_iter_page(response, page))
+
+        url = page.get('@odata.nextLink')
+        params = None
+        new_delta_link = page.get('@odata.deltaLink', new_delta_link)
+
+    return messages, new_delta_link
+
+
 def get_message_id(mailbox, folder_id, message_id_filter, access_token):
     """
     Retrieves the message ID from a specified folder within a mailbox using a filter query.
@@ -231,19 +474,19 @@ def get_message_id(mailbox, folder_id, message_id_filter, access_token):
     # Graph API endpoint for messages in the specified folder
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages"
 
+    # Only the first matching ID is needed, so avoid transferring other messages and their properties
     params = {
-        '$filter': message_id_filter
+        '$filter': message_id_filter,
+        '$top': 1,
+        '$select': 'id'
     }
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = _headers(access_token)
 
-    response = requests.get(url, headers=headers, params=params)
+    response = _session.get(url, headers=headers, params=params)
     response.raise_for_status()
 
-    data = response.json()
+    data = _parse(response)
 
     # Validate that we found matching messages
     if not data.get('value') or len(data['value']) == 0:
@@ -266,27 +509,17 @@ def get_message_details(mailbox, folder_id, message_id, access_token, select_fie
     :return: Dictionary containing detailed message information
     """
 
-    # Use default fields if none specified
-    if select_fields is None:
-        select_fields = default_fields
-
     # Graph API endpoint for specific message
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = _headers(access_token)
 
-    # Use the provided select_fields parameter instead of hardcoded default_fields
+    # Use the provided select_fields parameter, falling back to the precomputed default_fields selection
     params = {
-        '$select': ','.join(select_fields)
+        '$select': _default_select if select_fields is None else ','.join(select_fields)
     }
 
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-
-    data = response.json()
+    data = _get_conditional(url, headers, params)
 
     # Validate that message data was retrieved
     if not data:
@@ -311,15 +544,18 @@ def get_attachment_id(mailbox, folder_id, message_id, access_token):
     # Graph API endpoint for message attachments
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}/attachments"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
+    headers = _headers(access_token)
+
+    # Only the first ID is needed, so avoid transferring other attachments and their contentBytes
+    params = {
+        '$top': 1,
+        '$select': 'id'
     }
 
-    response = requests.get(url, headers=headers)
+    response = _session.get(url, headers=headers, params=params)
     response.raise_for_status()
 
-    data = response.json()
+    data = _parse(response)
 
     # Validate that message contains attachments
     if not data.get('value') or len(data['value']) == 0:
@@ -330,30 +566,44 @@ def get_attachment_id(mailbox, folder_id, message_id, access_token):
     return attachment_id
 
 
-def get_attachment_data(mailbox, folder_id, message_id, attachment_id, access_token):
+def get_attachment_data(mailbox, folder_id, message_id, attachment_id, access_token, dest_file=None, size=None):
     """
     Retrieves attachment metadata and raw content from a specified email attachment.
+    When the attachment size is known to be at most batch_attachment_max_size, metadata and content are fetched
+    in a single $batch round-trip; otherwise, or when dest_file is given, the content is streamed in chunks.
 
     :param mailbox: The email address of the mailbox to query
     :param folder_id: The ID of the folder containing the message
     :param message_id: The ID of the message containing the attachment
     :param attachment_id: The ID of the attachment to retrieve
     :param access_token: Bearer token for Microsoft Graph API authentication
-    :return: Dictionary containing attachment name, contentType, and raw content bytes
+    :param dest_file: Optional file path to write the attachment content to instead of returning it
+    :param size: Optional attachment size in bytes, as reported by Graph, enabling the single $batch round-trip
+    :return: Dictionary containing attachment name, contentType, and raw content bytes (or path when dest_file is given)
     """
 
+    # Only batch attachments known to be small enough that their base64 content fits a batch payload
+    if not dest_file and size is not None and size <= batch_attachment_max_size:
+        batch_requests = [
+            _attachment_sub_request(mailbox, folder_id, message_id, attachment_id, "0-meta"),
+            _attachment_sub_request(mailbox, folder_id, message_id, attachment_id, "0-value", content=True)
+        ]
+
+        responses = _post_batch(batch_requests, access_token)
+
+        # Fall back to the requests below if Graph refuses to return the content inside the batch
+        if responses.get('0-value', {}).get('status') == 200:
+            return _attachment_from_batch(responses, 0, attachment_id)
+
     # First, get attachment metadata to retrieve name and content type
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}/attachments/{attachment_id}"
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = _headers(access_token)
 
-    response = requests.get(url, headers=headers)
+    response = _session.get(url, headers=headers)
     response.raise_for_status()
 
-    data = response.json()
+    data = _parse(response)
 
     # Validate metadata response
     if not data:
@@ -366,25 +616,544 @@ def get_attachment_data(mailbox, folder_id, message_id, attachment_id, access_to
     # Get attachment binary content using the $value endpoint
     url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}/attachments/{attachment_id}/$value"
 
-    headers = {
+    with _session.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+
+        # The decoded size can only be checked against Content-Length when the body is not content-encoded
+        expected_size = None
+        if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+            expected_size = int(response.headers['Content-Length'])
+
+        size = 0
+
+        if dest_file:
+            # Write chunks straight to disk so the attachment is never held in memory
+            f = open(dest_file, 'wb')
+
+            # Never leave a truncated or empty evidence file behind, whatever interrupts the download
+            try:
+                with f:
+                    for chunk in response.iter_content(chunk_size=download_chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+
+                _check_attachment_size(size, expected_size)
+            except BaseException:
+                os.remove(dest_file)
+                raise
+
+            attachment_raw = None
+
+        else:
+            chunks = []
+            for chunk in response.iter_content(chunk_size=download_chunk_size):
+                chunks.append(chunk)
+                size += len(chunk)
+
+            attachment_raw = b''.join(chunks)
+
+            _check_attachment_size(size, expected_size)
+
+    # Return structured attachment data with metadata and content
+    attachment_data = {
+        'name': attachment_name,
+        'contentType': attachment_type,
+    }
+
+    if dest_file:
+        attachment_data['path'] = dest_file
+    else:
+        attachment_data['content'] = attachment_raw
+
+    return attachment_data
+
+
+def iter_attachment_chunks(content_bytes, chunk_size=download_chunk_size):
+    """
+    Decodes base64 attachment content, such as a fileAttachment contentBytes value, one chunk at a time.
+    The encoded string must already be in memory; only the decoded bytes are produced incrementally, so
+    callers can write them out without building a second full-size copy of the attachment.
+
+    :param content_bytes: The base64 encoded attachment content
+    :param chunk_size: Approximate number of decoded bytes per chunk (default: download_chunk_size)
+    :return: Generator yielding decoded content bytes
+    """
+
+    # Slice on 4-character boundaries so every slice is independently decodable
+    step = max(chunk_size // 3, 1) * 4
+
+    for start in range(0, len(content_bytes), step):
+        yield _base64.b64decode(content_bytes[start:start + step], validate=False)
+
+
+def get_messages_details_batch(mailbox, folder_id, message_ids, access_token, select_fields=None):
+    """
+    Retrieves detailed information about multiple messages using Graph $batch requests.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder containing the messages
+    :param message_ids: List of message IDs to retrieve details for
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :param select_fields: Optional list of specific fields to retrieve (defaults to default_fields)
+    :return: Dictionary with message IDs as keys and message detail dictionaries as values
+    """
+
+    # Use default fields if none specified
+    select = _default_select if select_fields is None else ','.join(select_fields)
+
+    # Build one GET sub-request per message, using the list index as the sub-request id
+    batch_requests = [
+        {
+            'id': str(index),
+            'method': 'GET',
+            'url': f"/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}?$select={select}"
+        }
+        for index, message_id in enumerate(message_ids)
+    ]
+
+    responses = _post_batch(batch_requests, access_token)
+
+    messages_details = {}
+
+    for index, message_id in enumerate(message_ids):
+        data = _check_batch_response(responses.get(str(index), {}))
+
+        # Validate that message data was retrieved
+        if not data:
+            raise ValueError(f"Message metadata not found for message: {message_id}")
+
+        messages_details[message_id] = data
+
+    return messages_details
+
+
+def get_attachments_data_batch(mailbox, folder_id, message_id, attachment_ids, access_token):
+    """
+    Retrieves metadata and raw content for multiple attachments of a message using Graph $batch requests.
+    Content is batched only for attachments of up to batch_attachment_max_size bytes; larger attachments are
+    streamed individually so their base64 encoded content is never held inside a batch response.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder containing the message
+    :param message_id: The ID of the message containing the attachments
+    :param attachment_ids: List of attachment IDs to retrieve
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :return: Dictionary with attachment IDs as keys and attachment data dictionaries as values
+    """
+
+    # Fetch metadata first so the size of each attachment is known before its content is requested
+    meta_requests = [
+        _attachment_sub_request(mailbox, folder_id, message_id, attachment_id, f"{index}-meta")
+        for index, attachment_id in enumerate(attachment_ids)
+    ]
+
+    responses = _post_batch(meta_requests, access_token)
+
+    small_attachments = []
+
+    for index, attachment_id in enumerate(attachment_ids):
+        data = _check_batch_response(responses.get(f"{index}-meta", {}))
+
+        if data and (data.get('size') or 0) <= batch_attachment_max_size:
+            small_attachments.append((index, attachment_id))
+
+    value_requests = [
+        _attachment_sub_request(mailbox, folder_id, message_id, attachment_id, f"{index}-value", content=True)
+        for index, attachment_id in small_attachments
+    ]
+
+    responses.update(_post_batch(value_requests, access_token))
+
+    attachments_data = {}
+
+    for index, attachment_id in enumerate(attachment_ids):
+        if (index, attachment_id) in small_attachments:
+            attachments_data[attachment_id] = _attachment_from_batch(responses, index, attachment_id)
+        else:
+            attachments_data[attachment_id] = get_attachment_data(mailbox, folder_id, message_id, attachment_id, access_token)
+
+    return attachments_data
+
+
+def get_all_messages_details(mailbox, folder_id, message_ids, access_token, select_fields=None, workers=max_workers):
+    """
+    Retrieves detailed information about multiple messages concurrently using a thread pool.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder containing the messages
+    :param message_ids: List of message IDs to retrieve details for
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :param select_fields: Optional list of specific fields to retrieve (defaults to default_fields)
+    :param workers: Maximum number of concurrent requests (default: max_workers)
+    :return: Dictionary with message IDs as keys and message detail dictionaries as values
+    """
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            message_id: executor.submit(
+                get_message_details, mailbox, folder_id, message_id, access_token, select_fields
+            )
+            for message_id in message_ids
+        }
+
+        try:
+            messages_details = {message_id: future.result() for message_id, future in futures.items()}
+        except BaseException:
+            # Cancel the requests that have not started yet so the error surfaces without running the whole sweep
+            for future in futures.values():
+                future.cancel()
+            raise
+
+    return messages_details
+
+
+def _check_attachment_size(size, expected_size):
+    """
+    Validates the number of attachment bytes received against the size announced by Graph.
+
+    :param size: Number of content bytes received
+    :param expected_size: Content-Length of the response, or None if it cannot be checked
+    """
+
+    # Never hand back a short read as if it were the complete attachment
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"Attachment content is incomplete: received {size} of {expected_size} bytes")
+
+    # Validate that attachment has content
+    if not size:
+        raise ValueError("Attachment has no content or is empty")
+
+
+def _parse(response):
+    """
+    Decodes a JSON response body, using orjson when it is installed.
+
+    :param response: The response returned by the Graph API
+    :return: The decoded JSON data
+    """
+
+    return _json.loads(response.content)
+
+
+@lru_cache(maxsize=8)
+def _headers(access_token):
+    """
+    Builds the request headers for an access token, cached so repeat calls reuse the same dictionary.
+    Callers must copy the dictionary before adding headers to it.
+
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :return: Dictionary of request headers
+    """
+
+    return {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
 
-    response = requests.get(url, headers=headers)
+
+def _get_conditional(url, headers, params=None):
+    """
+    Performs a GET request revalidated with If-None-Match, reusing the cached body on 304 Not Modified.
+
+    :param url: The Graph API URL to request
+    :param headers: Request headers for the call
+    :param params: Optional query parameters for the call
+    :return: The decoded JSON data
+    """
+
+    cache_key = (url, tuple(sorted(params.items())) if params else None)
+
+    with _etag_lock:
+        cached = _etag_cache.get(cache_key)
+
+    if cached:
+        headers = dict(headers, **{'If-None-Match': cached[0]})
+
+    response = _session.get(url, headers=headers, params=params)
     response.raise_for_status()
 
-    # Validate that attachment has content
-    if not response.content:
-        raise ValueError("Attachment has no content or is empty")
+    if cached and response.status_code == 304:
+        with _etag_lock:
+            if cache_key in _etag_cache:
+                _etag_cache.move_to_end(cache_key)
+        return _json.loads(cached[1])
 
-    attachment_raw = response.content
+    data = _parse(response)
+
+    # Only responses carrying an ETag can be revalidated later
+    etag = response.headers.get('ETag')
+    if etag:
+        _cache_etag(cache_key, etag, response.content)
+
+    return data
+
+
+def _cache_etag(cache_key, etag, content):
+    """
+    Stores a raw response body for revalidation, evicting the least recently used bodies beyond etag_cache_bytes.
+
+    :param cache_key: Tuple of (url, params) identifying the request
+    :param etag: The ETag returned with the response
+    :param content: The raw response body
+    """
+
+    global _etag_cache_size
+
+    # Bodies larger than the whole cache would only evict everything else
+    if len(content) > etag_cache_bytes:
+        return
+
+    with _etag_lock:
+        previous = _etag_cache.pop(cache_key, None)
+        if previous:
+            _etag_cache_size -= len(previous[1])
+
+        _etag_cache[cache_key] = (etag, content)
+        _etag_cache_size += len(content)
+
+        while _etag_cache_size > etag_cache_bytes:
+            _, (_, evicted) = _etag_cache.popitem(last=False)
+            _etag_cache_size -= len(evicted)
+
+
+def _token_digest(access_token):
+    """
+    Returns a short digest of an access token for use in cache keys, so the token itself is not retained.
+
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :return: Hex digest of the token
+    """
+
+    return hashlib.blake2b(access_token.encode(), digest_size=8).hexdigest()
+
+
+def _get_cached_folders(cache_key):
+    """
+    Returns a cached folder lookup, or None if it is missing or has expired.
+
+    :param cache_key: Tuple of (mailbox, token digest, lookup, argument) identifying the lookup
+    :return: The cached lookup result or None
+    """
+
+    with _folder_lock:
+        cached = _folder_cache.get(cache_key)
+        if cached is None:
+            return None
+
+        if time.monotonic() >= cached[1]:
+            del _folder_cache[cache_key]
+            return None
+
+        _folder_cache.move_to_end(cache_key)
+        return cached[0]
+
+
+def _cache_folders(cache_key, value):
+    """
+    Stores a folder lookup result for folder_cache_ttl seconds, evicting the least recently used beyond folder_cache_size.
+
+    :param cache_key: Tuple of (mailbox, token digest, lookup, argument) identifying the lookup
+    :param value: The lookup result to cache
+    """
+
+    now = time.monotonic()
+
+    with _folder_lock:
+        # Purge expired entries, such as lookups made with tokens that have since rotated
+        for expired_key in [key for key, (_, expiry) in _folder_cache.items() if now >= expiry]:
+            del _folder_cache[expired_key]
+
+        _folder_cache[cache_key] = (value, now + folder_cache_ttl)
+        _folder_cache.move_to_end(cache_key)
+
+        while len(_folder_cache) > folder_cache_size:
+            _folder_cache.popitem(last=False)
+
+
+def _iter_page(response, page):
+    """
+    Yields the items of a Graph collection page, parsing them incrementally when ijson is installed.
+
+    :param response: The streamed response for the collection page
+    :param page: Dictionary that receives the top-level @odata annotations of the page, such as @odata.nextLink
+    :return: Generator yielding item dictionaries
+    """
+
+    if _ijson is None:
+        data = _parse(response)
+        page.update((key, value) for key, value in data.items() if key.startswith('@odata.'))
+        yield from data.get('value', [])
+        return
+
+    # Let urllib3 undo any gzip or Brotli content encoding before the bytes reach the parser
+    response.raw.decode_content = True
+
+    builder = None
+
+    for prefix, event, value in _ijson.parse(response.raw, use_float=True):
+        if prefix == 'value.item' and event == 'start_map':
+            builder = _ijson.ObjectBuilder()
+
+        if builder is not None:
+            builder.event(event, value)
+
+            if prefix == 'value.item' and event == 'end_map':
+                yield builder.value
+                builder = None
+
+        elif prefix.startswith('@odata.') and event in ('string', 'number'):
+            page[prefix] = value
+
+
+def _drain(response):
+    """
+    Reads and discards the unread remainder of a streamed response so its connection can be reused.
+    At most drain_limit bytes are read; beyond that the connection is dropped when the response is closed.
+
+    :param response: The streamed response to drain
+    """
+
+    drained = 0
+
+    # Draining is only an optimisation, so it must never replace the exception that ended the iteration
+    try:
+        while drained < drain_limit:
+            chunk = response.raw.read(download_chunk_size)
+            if not chunk:
+                break
+            drained += len(chunk)
+    except Exception:
+        pass
+
+
+def _post_batch(batch_requests, access_token):
+    """
+    Sends sub-requests to the Graph $batch endpoint in chunks of batch_limit and merges the results.
+    Throttled or transiently failing sub-requests are resent after their Retry-After interval.
+
+    :param batch_requests: List of sub-request dictionaries with unique 'id' values
+    :param access_token: Bearer token for Microsoft Graph API authentication
+    :return: Dictionary with sub-request IDs as keys and sub-response dictionaries as values
+    """
+
+    headers = _headers(access_token)
+
+    responses = {}
+
+    pending = batch_requests
+
+    # Graph throttles individual sub-requests inside a successful batch, so those are retried here
+    for attempt in range(retry_total + 1):
+        throttled = []
+        delay = retry_backoff_factor * (2 ** attempt)
+
+        for start in range(0, len(pending), batch_limit):
+            chunk = pending[start:start + batch_limit]
+
+            payload = {
+                'requests': chunk
+            }
+
+            response = _session.post(batch_url, headers=headers, json=payload)
+            response.raise_for_status()
+
+            chunk_requests = {batch_request['id']: batch_request for batch_request in chunk}
+
+            for sub_response in _parse(response).get('responses', []):
+                if sub_response.get('status') in retry_status_codes and attempt < retry_total:
+                    throttled.append(chunk_requests[sub_response['id']])
+
+                    # Wait for the longest Retry-After interval reported by the throttled sub-requests
+                    retry_after = str((sub_response.get('headers') or {}).get('Retry-After', ''))
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                else:
+                    responses[sub_response['id']] = sub_response
+
+        if not throttled:
+            break
+
+        time.sleep(delay)
+        pending = throttled
+
+    return responses
+
+
+def _check_batch_response(sub_response):
+    """
+    Raises an HTTPError if a $batch sub-response reports a failed status.
+
+    :param sub_response: Sub-response dictionary returned by the $batch endpoint
+    :return: The body of the sub-response
+    """
+
+    status = sub_response.get('status', 0)
+
+    if status >= 400:
+        error = (sub_response.get('body') or {}).get('error', {})
+        raise requests.HTTPError(f"{status} Batch sub-request failed: {error.get('message', 'Unknown error')}")
+
+    return sub_response.get('body')
+
+
+def _attachment_sub_request(mailbox, folder_id, message_id, attachment_id, request_id, content=False):
+    """
+    Builds a $batch sub-request for the metadata or the $value content of an attachment.
+
+    :param mailbox: The email address of the mailbox to query
+    :param folder_id: The ID of the folder containing the message
+    :param message_id: The ID of the message containing the attachment
+    :param attachment_id: The ID of the attachment to retrieve
+    :param request_id: The sub-request ID, unique within the batch
+    :param content: Whether to request the $value content instead of the metadata
+    :return: Sub-request dictionary
+    """
+
+    url = f"/users/{mailbox}/mailFolders/{folder_id}/messages/{message_id}/attachments/{attachment_id}"
+
+    if content:
+        return {
+            'id': request_id,
+            'method': 'GET',
+            'url': f"{url}/$value",
+            'headers': {'Accept': '*/*'}
+        }
+
+    # Select only the metadata so file attachments do not also return their contentBytes
+    return {
+        'id': request_id,
+        'method': 'GET',
+        'url': f"{url}?$select=name,contentType,size"
+    }
+
+
+def _attachment_from_batch(responses, index, attachment_id):
+    """
+    Assembles attachment data from the metadata and $value sub-responses of an attachment batch.
+
+    :param responses: Dictionary of sub-responses returned by _post_batch
+    :param index: Position of the attachment in the batch
+    :param attachment_id: The ID of the attachment
+    :return: Dictionary containing attachment name, contentType, and raw content bytes
+    """
+
+    data = _check_batch_response(responses.get(f"{index}-meta", {}))
+
+    # Validate metadata response
+    if not data:
+        raise ValueError(f"Attachment metadata not found for attachment: {attachment_id}")
+
+    # Binary sub-response bodies are returned base64 encoded inside the batch JSON
+    content = _check_batch_response(responses.get(f"{index}-value", {}))
+
+    # Validate that attachment has content
+    if not content:
+        raise ValueError(f"Attachment has no content or is empty: {attachment_id}")
 
-    # Return structured attachment data with metadata and content
     attachment_data = {
-        'name': attachment_name,
-        'contentType': attachment_type,
-        'content': attachment_raw,
+        'name': data.get('name'),
+        'contentType': data.get('contentType'),
+        'content': _base64.b64decode(content, validate=False),
     }
 
     return attachment_data